@@ -1,13 +1,18 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
-from typing import Dict, Any, Optional
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+from typing import Dict, Any, List, Optional
+import asyncio
+import hashlib
 import logging
+import orjson
 import uuid
 from datetime import datetime
+from pydantic import ValidationError
 
 from config import Config
-from models import BillingRecord, BillingResponse, ArchiveResponse
-from archival_service import ArchivalService
+from models import BillingRecord, BillingResponse, BillingBatchResponse, ArchiveResponse
+from archival_service import ArchivalService, get_archival_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,38 +22,74 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Billing Records API with Archival",
     description="API for managing billing records with automatic archival to Azure Blob Storage",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson encodes response bodies in C instead of the stdlib json module
+    default_response_class=ORJSONResponse
 )
 
-# Initialize archival service
-archival_service = ArchivalService()
+# Compress responses large enough to benefit (batch results, archived records) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# Archival service singleton, created once on startup so every request shares
+# the same Cosmos DB / Blob Storage connection pools
+archival_service: Optional[ArchivalService] = None
 
 @app.on_event("startup")
 async def startup_event():
-    """Validate configuration on startup"""
+    """Validate configuration and initialize the archival service on startup"""
+    global archival_service
+    
     try:
         Config.validate()
         logger.info("Configuration validated successfully")
     except ValueError as e:
         logger.error(f"Configuration error: {str(e)}")
         raise
+    
+    archival_service = get_archival_service()
+    await archival_service.initialize()
+    logger.info("Archival service initialized")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the Azure clients on shutdown"""
+    if archival_service is not None:
+        await archival_service.close()
+        logger.info("Archival service closed")
 
-@app.get("/health")
+@app.api_route("/health", methods=["GET", "HEAD"])
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint; HEAD returns the status alone"""
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
+def _stored_record_fields(record_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Project a stored document onto the BillingRecord fields, dropping Cosmos DB system properties"""
+    for name, field in BillingRecord.model_fields.items():
+        if field.is_required() and name not in record_data:
+            raise RuntimeError(f"Stored billing record {record_data.get('id')} is missing required field: {name}")
+    
+    return {
+        name: record_data.get(name, field.get_default(call_default_factory=True))
+        for name, field in BillingRecord.model_fields.items()
+    }
+
 @app.get("/billing/{record_id}", response_model=BillingResponse)
 async def get_billing_record(record_id: str):
     """
     Retrieve a billing record by ID from either Cosmos DB or archived storage
     """
     try:
-        record_data = archival_service.get_billing_record(record_id)
+        record_data, source = await archival_service.get_billing_record(record_id)
         
-        # Determine the source
-        cosmos_record = archival_service.cosmos_client.get_billing_record(record_id)
-        source = "cosmos_db" if cosmos_record else "blob_storage"
+        if Config.TRUST_STORED_RECORDS:
+            # Stored documents were validated on write and are already JSON-shaped;
+            # returning a Response directly also skips FastAPI's response_model validation
+            return ORJSONResponse(content={
+                "success": True,
+                "data": _stored_record_fields(record_data),
+                "message": "Billing record retrieved successfully",
+                "source": source
+            })
         
         return BillingResponse(
             success=True,
@@ -57,27 +98,85 @@ async def get_billing_record(record_id: str):
             source=source
         )
         
+    except ValidationError as e:
+        # A ValueError too, but the record exists: its stored document is malformed
+        logger.error(f"Stored billing record {record_id} is invalid: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         logger.error(f"Error retrieving billing record {record_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/billing", response_model=BillingBatchResponse)
+async def get_billing_records(ids: str = Query(..., description="Comma-separated billing record IDs")):
+    """
+    Retrieve several billing records in one request, from either Cosmos DB or archived storage
+    """
+    record_ids = [record_id for record_id in ids.split(",") if record_id]
+    
+    # Lookups are independent, so they run concurrently
+    results = await asyncio.gather(
+        *[archival_service.get_billing_record(record_id) for record_id in record_ids],
+        return_exceptions=True
+    )
+    
+    records = []
+    missing = []
+    errors = []
+    failed = False
+    for record_id, result in zip(record_ids, results):
+        if isinstance(result, ValueError):
+            missing.append(record_id)
+        elif isinstance(result, Exception):
+            # A record that exists but cannot be read is an error, not a missing record
+            logger.error(f"Error retrieving billing record {record_id}: {str(result)}")
+            failed = True
+        else:
+            record_data, source = result
+            try:
+                record = BillingRecord(**record_data)
+            except ValidationError as e:
+                # One malformed document must not fail the rest of the batch
+                logger.error(f"Stored billing record {record_id} is invalid: {str(e)}")
+                errors.append(record_id)
+                continue
+            records.append(BillingResponse(success=True, data=record, source=source))
+    
+    if failed:
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+    return BillingBatchResponse(
+        success=not missing and not errors,
+        records=records,
+        missing=missing,
+        errors=errors,
+        message=f"Retrieved {len(records)} of {len(record_ids)} billing records"
+    )
+
+def _with_server_defaults(record: BillingRecord) -> BillingRecord:
+    """Fill in the server-side defaults of a new record (records are immutable, so on a copy)"""
+    defaults = {}
+    
+    # Generate ID if not provided
+    if not record.id:
+        defaults["id"] = str(uuid.uuid4())
+    
+    # Set creation timestamp if not provided
+    if not record.created_at:
+        defaults["created_at"] = datetime.utcnow()
+    
+    return record.model_copy(update=defaults) if defaults else record
+
 @app.post("/billing", response_model=BillingResponse)
 async def create_billing_record(record: BillingRecord):
     """
     Create a new billing record in Cosmos DB
     """
     try:
-        # Generate ID if not provided
-        if not record.id:
-            record.id = str(uuid.uuid4())
+        record = _with_server_defaults(record)
         
-        # Set creation timestamp if not provided
-        if not record.created_at:
-            record.created_at = datetime.utcnow()
-        
-        success = archival_service.cosmos_client.create_billing_record(record)
+        success = await archival_service.create_billing_record(record)
         
         if success:
             return BillingResponse(
@@ -93,6 +192,36 @@ async def create_billing_record(record: BillingRecord):
         logger.error(f"Error creating billing record: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/billing/batch", response_model=BillingBatchResponse)
+async def create_billing_records(records: List[BillingRecord]):
+    """
+    Create several billing records in Cosmos DB in one request
+    """
+    records = [_with_server_defaults(record) for record in records]
+    
+    # Records live in different partitions, so they are written concurrently rather than transactionally
+    results = await asyncio.gather(
+        *[archival_service.create_billing_record(record) for record in records],
+        return_exceptions=True
+    )
+    
+    created = []
+    missing = []
+    for record, result in zip(records, results):
+        if result is True:
+            created.append(BillingResponse(success=True, data=record, source="cosmos_db"))
+        else:
+            if isinstance(result, Exception):
+                logger.error(f"Error creating billing record {record.id}: {str(result)}")
+            missing.append(record.id)
+    
+    return BillingBatchResponse(
+        success=not missing,
+        records=created,
+        missing=missing,
+        message=f"Created {len(created)} of {len(records)} billing records"
+    )
+
 @app.put("/billing/{record_id}", response_model=BillingResponse)
 async def update_billing_record(record_id: str, updates: Dict[str, Any]):
     """
@@ -100,15 +229,13 @@ async def update_billing_record(record_id: str, updates: Dict[str, Any]):
     """
     try:
         # First check if record exists
-        existing_record = archival_service.get_billing_record(record_id)
+        existing_record, _ = await archival_service.get_billing_record(record_id)
         if not existing_record:
             raise HTTPException(status_code=404, detail="Billing record not found")
         
-        success = archival_service.cosmos_client.update_billing_record(record_id, updates)
+        updated_record = await archival_service.cosmos_client.update_billing_record(record_id, updates)
         
-        if success:
-            # Get updated record
-            updated_record = archival_service.get_billing_record(record_id)
+        if updated_record:
             return BillingResponse(
                 success=True,
                 data=BillingRecord(**updated_record),
@@ -131,18 +258,16 @@ async def delete_billing_record(record_id: str):
     """
     try:
         # Check if record exists
-        existing_record = archival_service.get_billing_record(record_id)
+        existing_record, _ = await archival_service.get_billing_record(record_id)
         if not existing_record:
             raise HTTPException(status_code=404, detail="Billing record not found")
         
-        # Delete from Cosmos DB
-        cosmos_deleted = archival_service.cosmos_client.delete_record(record_id)
-        
-        # Delete from blob storage if it exists there
-        blob_deleted = archival_service.blob_client.delete_billing_record(record_id)
+        # Delete from Cosmos DB and from blob storage if it exists there
+        deleted = await archival_service.delete_billing_record(record_id)
         
-        if cosmos_deleted or blob_deleted:
-            return {"success": True, "message": "Billing record deleted successfully"}
+        if deleted:
+            # Archived copies are erased from blob storage too, not just unlinked from the index
+            return {"success": True, "message": "Billing record deleted successfully, including any archived copy"}
         else:
             raise HTTPException(status_code=500, detail="Failed to delete billing record")
             
@@ -172,25 +297,44 @@ async def trigger_archival(background_tasks: BackgroundTasks):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/archive/sync", response_model=ArchiveResponse)
-async def trigger_sync_archival():
+async def trigger_sync_archival(
+    dry_run: bool = Query(False, description="Only count the records that would be archived; write nothing")
+):
     """
     Trigger the archival process synchronously and return results
     """
     try:
-        result = archival_service.archive_old_records()
+        result = await archival_service.archive_old_records(dry_run=dry_run)
         return result
         
     except Exception as e:
         logger.error(f"Error during sync archival: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/archive/purge")
+async def purge_archived_records(record_ids: List[str]):
+    """
+    Permanently remove archived records from blob storage and the archive index
+    """
+    try:
+        purged_count = await archival_service.purge_archived(record_ids)
+        return {
+            "success": purged_count == len(record_ids),
+            "purged_count": purged_count,
+            "message": f"Purged {purged_count} of {len(record_ids)} archived records"
+        }
+        
+    except Exception as e:
+        logger.error(f"Error purging archived records: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.post("/restore/{record_id}")
 async def restore_record(record_id: str):
     """
     Restore a record from blob storage back to Cosmos DB
     """
     try:
-        success = archival_service.restore_record(record_id)
+        success = await archival_service.restore_record(record_id)
         
         if success:
             return {"success": True, "message": f"Record {record_id} restored successfully"}
@@ -204,13 +348,20 @@ async def restore_record(record_id: str):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/stats")
-async def get_archival_stats():
+async def get_archival_stats(request: Request):
     """
     Get statistics about the archival system
     """
     try:
-        stats = archival_service.get_archival_stats()
-        return stats
+        stats = await archival_service.get_archival_stats()
+        body = orjson.dumps(stats)
+        
+        # Weak ETag over the counters, so pollers get an empty 304 while nothing has changed
+        etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
         
     except Exception as e:
         logger.error(f"Error getting archival stats: {str(e)}")
@@ -1,6 +1,10 @@
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+import asyncio
+import time
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 import logging
+from cachetools import TTLCache
 from config import Config
 from cosmos_client import CosmosDBClient
 from blob_client import BlobStorageClient
@@ -12,22 +16,115 @@ class ArchivalService:
     def __init__(self):
         self.cosmos_client = CosmosDBClient()
         self.blob_client = BlobStorageClient()
+        
+        # Caps the number of records archived concurrently within a batch
+        self._sem = asyncio.Semaphore(Config.ARCHIVAL_CONCURRENCY)
+        
+        # Archived records are immutable once written to blob storage, so repeated
+        # reads can be served from memory instead of re-downloading the blob
+        self._archive_cache = TTLCache(maxsize=Config.ARCHIVE_CACHE_SIZE, ttl=Config.ARCHIVE_CACHE_TTL)
+        
+        # Briefly remember IDs that were found nowhere, so repeated misses skip the lookups
+        self._not_found_cache = TTLCache(maxsize=Config.ARCHIVE_CACHE_SIZE, ttl=Config.NOT_FOUND_CACHE_TTL)
+        
+        # Statistics do not need to be real-time
+        self._stats_cache = TTLCache(maxsize=1, ttl=Config.STATS_CACHE_TTL)
+        
+        self._initialized = False
+    
+    async def initialize(self):
+        """
+        Ensure the backing Cosmos DB containers and blob container exist (no-op once initialized)
+        """
+        if self._initialized:
+            return
+        
+        # Rebuilt on every initialize(): each FastAPI lifespan (e.g. each in-process TestClient)
+        # may run on a new event loop, and the primitive binds to the loop it is first used on
+        self._sem = asyncio.Semaphore(Config.ARCHIVAL_CONCURRENCY)
+        
+        await self.cosmos_client.initialize()
+        await self.blob_client.initialize()
+        self._initialized = True
     
-    def archive_old_records(self) -> ArchiveResponse:
+    async def close(self):
         """
-        Main archival process that moves records older than the threshold from Cosmos DB to Blob Storage
+        Close the Cosmos DB and Blob Storage clients and their connection pools
+        """
+        await self.cosmos_client.close()
+        await self.blob_client.close()
+        self._initialized = False
+    
+    async def archive_old_records(self, dry_run: bool = False) -> ArchiveResponse:
+        """
+        Main archival process that moves records older than the threshold from Cosmos DB to Blob Storage.
+        With dry_run, only counts the records that would be archived and writes nothing.
         """
         try:
             # Calculate cutoff date
             cutoff_date = datetime.utcnow() - timedelta(days=Config.ARCHIVAL_DAYS_THRESHOLD)
             cutoff_date_str = cutoff_date.isoformat()
             
+            if dry_run:
+                eligible_count = await self.cosmos_client.count_records_to_archive(cutoff_date_str)
+                
+                logger.info(f"Dry run: {eligible_count} records older than {cutoff_date_str} would be archived")
+                return ArchiveResponse(
+                    success=True,
+                    archived_count=eligible_count,
+                    message=f"Dry run: {eligible_count} records would be archived"
+                )
+            
             logger.info(f"Starting archival process for records older than: {cutoff_date_str}")
             
-            # Get records to archive
-            records_to_archive = self.cosmos_client.get_records_to_archive(cutoff_date_str)
+            # Three pipelined stages: while one page is being queried, the previous one
+            # is uploaded and the one before that is indexed and deleted from Cosmos DB
+            pages: asyncio.Queue = asyncio.Queue(maxsize=2)
+            shards: asyncio.Queue = asyncio.Queue(maxsize=2)
+            archived_count = 0
+            found_count = 0
+            
+            async def produce():
+                nonlocal found_count
+                try:
+                    # Large query pages keep round-trips down; each page is archived in BATCH_SIZE shards
+                    async for page in self.cosmos_client.iter_record_pages_to_archive(cutoff_date_str, Config.ARCHIVAL_PAGE_SIZE):
+                        found_count += len(page)
+                        for start in range(0, len(page), Config.BATCH_SIZE):
+                            await pages.put(page[start:start + Config.BATCH_SIZE])
+                finally:
+                    # Always release the next stage, even if the query fails
+                    await pages.put(None)
             
-            if not records_to_archive:
+            async def upload():
+                try:
+                    while (batch := await pages.get()) is not None:
+                        shard = await self._upload_batch(batch)
+                        if shard:
+                            await shards.put(shard)
+                finally:
+                    await shards.put(None)
+            
+            async def finalize():
+                nonlocal archived_count
+                batch_number = 0
+                while (shard := await shards.get()) is not None:
+                    batch_number += 1
+                    batch_started = time.perf_counter()
+                    batch_archived = await self._finalize_batch(*shard)
+                    archived_count += batch_archived
+                    
+                    # One summary line per batch; per-record operations are logged at DEBUG
+                    logger.info("Processed batch %d, archived %d records in %.2fs",
+                                batch_number, batch_archived, time.perf_counter() - batch_started)
+            
+            try:
+                await asyncio.gather(produce(), upload(), finalize())
+            finally:
+                # The counts changed, even if the run stopped part-way
+                self._stats_cache.clear()
+            
+            if not found_count:
                 logger.info("No records found for archival")
                 return ArchiveResponse(
                     success=True,
@@ -35,16 +132,6 @@ class ArchivalService:
                     message="No records found for archival"
                 )
             
-            archived_count = 0
-            
-            # Process records in batches
-            for i in range(0, len(records_to_archive), Config.BATCH_SIZE):
-                batch = records_to_archive[i:i + Config.BATCH_SIZE]
-                batch_archived = self._archive_batch(batch)
-                archived_count += batch_archived
-                
-                logger.info(f"Processed batch {i//Config.BATCH_SIZE + 1}, archived {batch_archived} records")
-            
             logger.info(f"Archival process completed. Total records archived: {archived_count}")
             
             return ArchiveResponse(
@@ -61,95 +148,172 @@ class ArchivalService:
                 message=f"Archival process failed: {str(e)}"
             )
     
-    def _archive_batch(self, records: List[Dict[str, Any]]) -> int:
+    async def _upload_batch(self, records: List[Dict[str, Any]]) -> Optional[Tuple[List[Dict[str, Any]], str, List[Tuple[int, int]]]]:
+        """
+        Upload a batch of records as one shard; returns the uploaded records, shard path and extents, or None on failure
+        """
+        valid_records = [record for record in records if record.get('id')]
+        if len(valid_records) < len(records):
+            logger.warning(f"Skipping {len(records) - len(valid_records)} records missing ID")
+        if not valid_records:
+            return None
+        
+        # One PUT per batch instead of one per record
+        try:
+            blob_path, extents = await self.blob_client.upload_billing_records_shard(valid_records)
+        except Exception as e:
+            logger.error(f"Error uploading shard for batch of {len(valid_records)} records: {str(e)}")
+            return None
+        
+        return valid_records, blob_path, extents
+    
+    async def _finalize_batch(self, valid_records: List[Dict[str, Any]], blob_path: str, extents: List[Tuple[int, int]]) -> int:
         """
-        Archive a batch of records
+        Index and delete every record of an uploaded shard concurrently, bounded by the archival semaphore
         """
-        archived_count = 0
+        # One timestamp for the whole batch
+        archived_at = datetime.utcnow()
         
-        for record in records:
+        tasks = [
+            self._finalize_one(record, blob_path, offset, length, archived_at)
+            for record, (offset, length) in zip(valid_records, extents)
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return sum(1 for result in results if result is True)
+    
+    async def _finalize_one(self, record: Dict[str, Any], blob_path: str, offset: int, length: int, archived_at: datetime) -> bool:
+        """
+        Finish archiving a record already written to a shard: write the archive index, delete from Cosmos DB
+        """
+        async with self._sem:
             try:
-                record_id = record.get('id')
-                if not record_id:
-                    logger.warning("Record missing ID, skipping")
-                    continue
+                record_id = record['id']
                 
-                # Upload to blob storage
-                blob_path = self.blob_client.upload_billing_record(record_id, record)
+                # Parse created_at only when it is actually a string
+                created_at = record.get('created_at')
+                if not isinstance(created_at, datetime):
+                    created_at = datetime.fromisoformat(created_at) if created_at else archived_at
                 
-                # Create archive index
+                # Create archive index pointing at the record's byte range in the shard
                 archive_index = ArchiveIndex(
                     id=record_id,
                     blob_path=blob_path,
-                    archived_at=datetime.utcnow(),
-                    original_created_at=datetime.fromisoformat(record.get('created_at', datetime.utcnow().isoformat()))
+                    offset=offset,
+                    length=length,
+                    archived_at=archived_at,
+                    original_created_at=created_at
                 )
                 
-                self.cosmos_client.create_archive_index(archive_index)
+                # The index write and the delete below stay as two point operations:
+                # stored procedures and transactional batches are scoped to a single
+                # container and partition key, and both containers are partitioned
+                # on /id, so there is nothing to coalesce server-side per batch
+                await self.cosmos_client.create_archive_index(archive_index)
                 
                 # Delete from Cosmos DB
-                self.cosmos_client.delete_record(record_id)
+                await self.cosmos_client.delete_record(record_id)
                 
-                archived_count += 1
-                logger.debug(f"Successfully archived record: {record_id}")
+                logger.debug("Successfully archived record: %s", record_id)
+                return True
                 
             except Exception as e:
                 logger.error(f"Error archiving record {record.get('id', 'unknown')}: {str(e)}")
-                # Continue with next record instead of failing the entire batch
-                continue
-        
-        return archived_count
+                # Report the failure instead of failing the entire batch
+                return False
+    
+    async def _download_archived(self, archive_index: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Download an archived record through its index entry (a byte range for sharded records)
+        """
+        return await self.blob_client.download_billing_record_by_path(
+            archive_index['blob_path'],
+            archive_index.get('offset'),
+            archive_index.get('length')
+        )
+    
+    async def _delete_archived_blob(self, archive_index: Dict[str, Any]) -> bool:
+        """
+        Remove the archived bytes behind an index entry: the whole blob for a per-record blob,
+        or just the record's range for a shard shared with other records
+        """
+        if archive_index.get('offset') is not None:
+            return await self.blob_client.erase_shard_ranges(
+                archive_index['blob_path'],
+                [(archive_index['offset'], archive_index['length'])]
+            )
+        return await self.blob_client.delete_billing_record_by_path(archive_index['blob_path'])
     
-    def get_billing_record(self, record_id: str) -> Dict[str, Any]:
+    async def get_billing_record(self, record_id: str) -> Tuple[Dict[str, Any], str]:
         """
-        Retrieve a billing record from either Cosmos DB or Blob Storage
+        Retrieve a billing record from either Cosmos DB or Blob Storage.
+        Returns the record together with its source ("cosmos_db" or "blob_storage").
         """
-        # First try Cosmos DB
-        record = self.cosmos_client.get_billing_record(record_id)
+        if record_id in self._not_found_cache:
+            raise ValueError(f"Billing record not found: {record_id}")
+        
+        # Look in Cosmos DB and the archive index at the same time (one round-trip on a miss)
+        record, archive_index = await self.cosmos_client.get_record_or_archive(record_id)
         if record:
-            return record
+            # Cosmos DB first: another process may have restored a record this one still has cached
+            return record, "cosmos_db"
         
-        # If not found in Cosmos DB, check archive index
-        archive_index = self.cosmos_client.get_archive_index(record_id)
         if archive_index:
+            # Serve recently read archived records from the cache instead of re-downloading the blob;
+            # only while the index entry exists, since a delete elsewhere removes it
+            if record_id in self._archive_cache:
+                return self._archive_cache[record_id], "blob_storage"
+            
             # Retrieve from blob storage using the stored path
-            record = self.blob_client.download_billing_record_by_path(archive_index['blob_path'])
+            record = await self._download_archived(archive_index)
             if record:
-                return record
+                self._archive_cache[record_id] = record
+                return record, "blob_storage"
         
-        # If still not found, try direct blob lookup (fallback)
-        record = self.blob_client.download_billing_record(record_id)
-        if record:
-            return record
-        
-        # Record not found anywhere
+        # Record not found anywhere; every archived record has an index entry
+        self._not_found_cache[record_id] = True
         raise ValueError(f"Billing record not found: {record_id}")
     
-    def restore_record(self, record_id: str) -> bool:
+    async def create_billing_record(self, record: BillingRecord) -> bool:
+        """
+        Create a billing record in Cosmos DB
+        """
+        success = await self.cosmos_client.create_billing_record(record)
+        
+        # The ID may have been looked up (and missed) just before it was created
+        self._not_found_cache.pop(record.id, None)
+        self._stats_cache.clear()
+        return success
+    
+    async def restore_record(self, record_id: str) -> bool:
         """
         Restore a record from blob storage back to Cosmos DB
         """
         try:
             # Get archive index
-            archive_index = self.cosmos_client.get_archive_index(record_id)
+            archive_index = await self.cosmos_client.get_archive_index(record_id)
             if not archive_index:
                 logger.warning(f"No archive index found for record: {record_id}")
                 return False
             
             # Download from blob storage
-            record = self.blob_client.download_billing_record_by_path(archive_index['blob_path'])
+            record = await self._download_archived(archive_index)
             if not record:
                 logger.warning(f"Record not found in blob storage: {record_id}")
                 return False
             
             # Create in Cosmos DB
-            self.cosmos_client.create_billing_record(BillingRecord(**record))
+            await self.cosmos_client.create_billing_record(BillingRecord(**record))
             
             # Delete from blob storage
-            self.blob_client.delete_billing_record(record_id)
+            await self._delete_archived_blob(archive_index)
             
             # Delete archive index
-            self.cosmos_client.delete_record(record_id)  # This deletes from archive index container
+            await self.cosmos_client.delete_archive_index(record_id)
+            
+            # The record lives in Cosmos DB again; drop the archived copy from the cache
+            self._archive_cache.pop(record_id, None)
+            self._stats_cache.clear()
             
             logger.info(f"Successfully restored record: {record_id}")
             return True
@@ -158,33 +322,112 @@ class ArchivalService:
             logger.error(f"Error restoring record {record_id}: {str(e)}")
             return False
     
-    def get_archival_stats(self) -> Dict[str, Any]:
+    async def delete_billing_record(self, record_id: str) -> bool:
+        """
+        Delete a billing record from Cosmos DB and blob storage
+        """
+        cosmos_deleted = await self.cosmos_client.delete_record(record_id)
+        
+        # Archived copies are located through the index, which also has to go
+        blob_deleted = False
+        archive_index = await self.cosmos_client.get_archive_index(record_id)
+        if archive_index:
+            blob_deleted = await self._delete_archived_blob(archive_index)
+            await self.cosmos_client.delete_archive_index(record_id)
+        
+        self._archive_cache.pop(record_id, None)
+        self._stats_cache.clear()
+        
+        return cosmos_deleted or blob_deleted
+    
+    async def purge_archived(self, record_ids: List[str]) -> int:
+        """
+        Permanently remove archived records: their blobs (or ranges of shared shards),
+        archive index entries and cached copies. Returns the number of index entries removed.
+        """
+        async def lookup(record_id: str):
+            async with self._sem:
+                return await self.cosmos_client.get_archive_index(record_id)
+        
+        indexes = [index for index in await asyncio.gather(*[lookup(record_id) for record_id in record_ids]) if index]
+        
+        # Per-record blobs go in batched deletes; each shard is rewritten once for all its purged ranges
+        blob_paths = [index['blob_path'] for index in indexes if index.get('offset') is None]
+        shard_extents: Dict[str, List[Tuple[int, int]]] = {}
+        for index in indexes:
+            if index.get('offset') is not None:
+                shard_extents.setdefault(index['blob_path'], []).append((index['offset'], index['length']))
+        
+        # Keep the index entries of records whose blob could not be deleted, so the purge can be retried
+        failed_blobs = set()
+        if blob_paths:
+            gone = await self.blob_client.delete_many(blob_paths)
+            for path, deleted in zip(blob_paths, gone):
+                if not deleted:
+                    logger.error(f"Error deleting purged record blob {path}")
+                    failed_blobs.add(path)
+        
+        async def erase(blob_path: str, extents: List[Tuple[int, int]]) -> bool:
+            async with self._sem:
+                return await self.blob_client.erase_shard_ranges(blob_path, extents)
+        
+        shard_paths = list(shard_extents)
+        erased = await asyncio.gather(*[erase(path, shard_extents[path]) for path in shard_paths], return_exceptions=True)
+        
+        # Likewise for records whose shard could not be rewritten
+        failed_shards = set()
+        for path, result in zip(shard_paths, erased):
+            if isinstance(result, Exception):
+                logger.error(f"Error erasing purged records from shard {path}: {str(result)}")
+                failed_shards.add(path)
+        failed_paths = failed_blobs | failed_shards
+        indexes = [index for index in indexes if index['blob_path'] not in failed_paths]
+        
+        async def drop_index(record_id: str) -> bool:
+            async with self._sem:
+                return await self.cosmos_client.delete_archive_index(record_id)
+        
+        results = await asyncio.gather(*[drop_index(index['id']) for index in indexes], return_exceptions=True)
+        
+        for record_id in record_ids:
+            self._archive_cache.pop(record_id, None)
+        self._stats_cache.clear()
+        
+        purged_count = sum(1 for result in results if result is True)
+        logger.info(f"Purged {purged_count} archived records")
+        return purged_count
+    
+    async def get_archival_stats(self) -> Dict[str, Any]:
         """
         Get statistics about the archival system
         """
+        if "stats" in self._stats_cache:
+            return self._stats_cache["stats"]
+        
         try:
-            # Count records in Cosmos DB
-            cosmos_count = len(list(self.cosmos_client.container.query_items(
-                query="SELECT VALUE COUNT(1) FROM c",
-                enable_cross_partition_query=True
-            )))
-            
-            # Count archive index entries
-            archive_count = len(list(self.cosmos_client.archive_index_container.query_items(
-                query="SELECT VALUE COUNT(1) FROM c",
-                enable_cross_partition_query=True
-            )))
+            # Read the maintained item counters instead of scanning both containers
+            counts = await self.cosmos_client.get_counts()
             
             # List archived blobs
-            archived_blobs = self.blob_client.list_archived_records()
+            archived_blobs = await self.blob_client.list_archived_records()
             
-            return {
-                "cosmos_db_records": cosmos_count,
-                "archived_records": archive_count,
+            stats = {
+                "cosmos_db_records": counts["records"],
+                "archived_records": counts["archive_index"],
                 "blob_storage_files": len(archived_blobs),
                 "archival_threshold_days": Config.ARCHIVAL_DAYS_THRESHOLD
             }
             
+            self._stats_cache["stats"] = stats
+            return stats
+            
         except Exception as e:
             logger.error(f"Error getting archival stats: {str(e)}")
-            return {"error": str(e)} 
\ No newline at end of file
+            return {"error": str(e)}
+
+@lru_cache()
+def get_archival_service() -> ArchivalService:
+    """
+    Process-wide ArchivalService, so every caller shares the same connection pools
+    """
+    return ArchivalService() 
\ No newline at end of file
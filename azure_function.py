@@ -4,13 +4,17 @@ from datetime import datetime
 import json
 
 # Import our archival service
-from archival_service import ArchivalService
+from archival_service import get_archival_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def main(mytimer: func.TimerRequest) -> None:
+# Created once per worker process; Azure Functions reuses the process across
+# timer invocations, so the Cosmos DB / Blob Storage connections stay warm
+archival_service = get_archival_service()
+
+async def main(mytimer: func.TimerRequest) -> None:
     """
     Azure Function that runs on a schedule to archive old billing records
     """
@@ -24,11 +28,11 @@ def main(mytimer: func.TimerRequest) -> None:
     logger.info(f'Python timer trigger function ran at {utc_timestamp}')
     
     try:
-        # Initialize archival service
-        archival_service = ArchivalService()
+        # Container checks and connection setup only run on the first invocation
+        await archival_service.initialize()
         
         # Run the archival process
-        result = archival_service.archive_old_records()
+        result = await archival_service.archive_old_records()
         
         # Log the results
         if result.success:
@@ -1,126 +1,295 @@
-from azure.storage.blob import BlobServiceClient, ContainerClient
-from azure.core.exceptions import ResourceNotFoundError
-from typing import Optional, Dict, Any
-import json
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from typing import Optional, Dict, Any, List, Tuple
+from datetime import datetime
+import asyncio
+import struct
+import uuid
+import os
+import orjson
+import zstandard as zstd
 import logging
 from config import Config
 from models import ArchiveIndex
+from resilience import blob_breaker, transient_retry
 
 logger = logging.getLogger(__name__)
 
+# Per-upload parallelism, following Azure's clamp(ncpu * 2, 8, 32) guidance
+UPLOAD_MAX_CONCURRENCY = min(32, max(8, (os.cpu_count() or 1) * 2))
+
+# The Blob Batch API accepts at most 256 sub-requests per batch
+BLOB_BATCH_LIMIT = 256
+
+# Archived JSON compresses well; level 3 keeps compression cheap on the archival path
+ZSTD_LEVEL = 3
+
+# Blob metadata key recording which trained dictionary a blob was compressed with
+ZSTD_DICT_METADATA_KEY = "zstd_dict_id"
+
+# Magic number of a zstd skippable frame: decoders skip its payload and return no data.
+# Erased shard records are overwritten with one, so the other records keep their offsets
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+# Attempts at rewriting a shard that another writer changed between read and write
+SHARD_REWRITE_ATTEMPTS = 5
+
+def _load_dictionary() -> Optional[zstd.ZstdCompressionDict]:
+    """Load the trained zstd dictionary configured by ZSTD_DICTIONARY_PATH, if any"""
+    if not Config.ZSTD_DICTIONARY_PATH:
+        return None
+    
+    with open(Config.ZSTD_DICTIONARY_PATH, "rb") as f:
+        dictionary = zstd.ZstdCompressionDict(f.read())
+    
+    # Precompute once, so the dictionary is only read when shared across compressors and threads
+    dictionary.precompute_compress(level=ZSTD_LEVEL)
+    logger.info(f"Loaded zstd dictionary {dictionary.dict_id()} from {Config.ZSTD_DICTIONARY_PATH}")
+    return dictionary
+
+ZSTD_DICTIONARY = _load_dictionary()
+
+class ZstdDictionaryMissingError(RuntimeError):
+    """A blob needs a zstd dictionary this process has not loaded (a configuration error, not a missing record)"""
+
 class BlobStorageClient:
+    _decompressor = zstd.ZstdDecompressor()
+    _dict_decompressor = zstd.ZstdDecompressor(dict_data=ZSTD_DICTIONARY) if ZSTD_DICTIONARY else None
+    
     def __init__(self):
+        # Created in initialize(): a closed client's HTTP transport cannot be reopened,
+        # so every initialize() after a close() needs fresh SDK clients
+        self.blob_service_client = None
+        self.container_client = None
+    
+    async def initialize(self):
+        """Prepare the client for use (must be awaited once before other calls)"""
         self.blob_service_client = BlobServiceClient.from_connection_string(Config.BLOB_CONNECTION_STRING)
         self.container_client = self.blob_service_client.get_container_client(Config.BLOB_CONTAINER)
-        
-        # Ensure container exists
-        self._ensure_container_exists()
+        await self._ensure_container_exists()
     
-    def _ensure_container_exists(self):
+    async def close(self):
+        """Close the underlying HTTP session"""
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
+            self.blob_service_client = None
+            self.container_client = None
+    
+    async def _ensure_container_exists(self):
         """Ensure the blob container exists"""
         try:
-            self.container_client.get_container_properties()
+            await self.container_client.get_container_properties()
         except ResourceNotFoundError:
             logger.info(f"Creating blob container: {Config.BLOB_CONTAINER}")
-            self.container_client.create_container()
+            await self.container_client.create_container()
+    
+    @staticmethod
+    def _shard_name(archive_date: str) -> str:
+        """Blob name for a new shard, prefixed with part of its ID so writes spread across partitions"""
+        shard_id = uuid.uuid4().hex
+        return f"{shard_id[:3]}/shards/{archive_date}/{shard_id}.jsonl.zst"
+    
+    async def _read_json_blob(self, blob_client, offset: Optional[int] = None, length: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Stream a blob (or a byte range of it) into a single buffer and parse it as JSON (None if erased)"""
+        downloader = await blob_client.download_blob(offset=offset, length=length)
+        
+        buf = bytearray()
+        async for chunk in downloader.chunks():
+            buf += chunk
+        
+        # Blobs archived before compression was introduced are plain JSON
+        if downloader.properties.content_settings.content_encoding == "zstd":
+            decompressor = self._decompressor_for(downloader.properties.metadata)
+            payload = decompressor.decompress(buf)
+            # An erased shard record decompresses to nothing
+            return orjson.loads(payload) if payload else None
+        return orjson.loads(buf)
+    
+    def _decompressor_for(self, metadata: Optional[Dict[str, str]]) -> zstd.ZstdDecompressor:
+        """Pick the decompressor matching the dictionary recorded in a blob's metadata"""
+        dict_id = (metadata or {}).get(ZSTD_DICT_METADATA_KEY)
+        if not dict_id:
+            return self._decompressor
+        
+        if ZSTD_DICTIONARY is None or str(ZSTD_DICTIONARY.dict_id()) != dict_id:
+            raise ZstdDictionaryMissingError(f"Blob was compressed with zstd dictionary {dict_id}, which is not loaded")
+        return self._dict_decompressor
+    
+    @staticmethod
+    def _compression_metadata() -> Optional[Dict[str, str]]:
+        """Blob metadata for newly compressed blobs"""
+        if ZSTD_DICTIONARY is None:
+            return None
+        return {ZSTD_DICT_METADATA_KEY: str(ZSTD_DICTIONARY.dict_id())}
+    
+    @staticmethod
+    def _serialize_record(record_data: Dict[str, Any]) -> bytes:
+        """Serialize a raw record document (e.g. straight from Cosmos DB) to JSON bytes without an intermediate str"""
+        return orjson.dumps(record_data, default=str, option=orjson.OPT_NAIVE_UTC)
+    
+    @classmethod
+    def _encode_shard(cls, records: List[Dict[str, Any]]) -> Tuple[bytes, List[Tuple[int, int]]]:
+        """Encode records as a JSONL shard; returns the shard bytes and each record's (offset, length)"""
+        # Compressor objects are not thread-safe, so each worker call gets its own
+        compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=ZSTD_DICTIONARY)
+        
+        # Each line is its own zstd frame, so a single record can be read back
+        # with a byte-range GET and decompressed without touching its neighbours
+        buf = bytearray()
+        extents = []
+        for record in records:
+            frame = compressor.compress(cls._serialize_record(record) + b"\n")
+            extents.append((len(buf), len(frame)))
+            buf += frame
+        
+        return bytes(buf), extents
     
-    def upload_billing_record(self, record_id: str, record_data: Dict[str, Any]) -> str:
-        """Upload a billing record to blob storage with Cool tier for cost optimization"""
+    async def upload_billing_records_shard(self, records: List[Dict[str, Any]]) -> Tuple[str, List[Tuple[int, int]]]:
+        """
+        Upload a batch of records as a single JSONL shard with Cool tier.
+        Returns the shard path and the (offset, length) of every record, in input order.
+        """
+        # Name and encode the shard once, outside the retried upload: if a PUT succeeds
+        # but its response is lost, the retry overwrites the same blob instead of orphaning it
+        blob_name = self._shard_name(datetime.utcnow().strftime("%Y/%m/%d"))
+        
+        # Encoding a whole batch is CPU-bound; keep it off the event loop
+        loop = asyncio.get_running_loop()
+        data, extents = await loop.run_in_executor(None, self._encode_shard, records)
+        
+        await self._put_shard(blob_name, data, len(records))
+        return blob_name, extents
+    
+    @transient_retry
+    @blob_breaker
+    async def _put_shard(self, blob_name: str, data: bytes, record_count: int):
+        """Write shard bytes to a fixed blob name; safe to retry"""
         try:
-            blob_name = f"{record_id}.json"
             blob_client = self.container_client.get_blob_client(blob_name)
             
-            # Convert record data to JSON string
-            json_data = json.dumps(record_data, default=str)
-            
-            # Upload the blob with Cool tier for cost optimization
-            blob_client.upload_blob(
-                json_data, 
+            await blob_client.upload_blob(
+                data,
                 overwrite=True,
-                standard_blob_tier="Cool"  # Use Cool tier for archived data
+                content_settings=ContentSettings(content_type="application/x-ndjson", content_encoding="zstd"),
+                metadata=self._compression_metadata(),
+                standard_blob_tier="Cool",  # Use Cool tier for archived data
+                max_concurrency=UPLOAD_MAX_CONCURRENCY
             )
             
-            logger.info(f"Uploaded billing record to blob storage (Cool tier): {blob_name}")
-            return blob_name
+            logger.info(f"Uploaded shard of {record_count} billing records to blob storage (Cool tier): {blob_name}")
         except Exception as e:
-            logger.error(f"Error uploading billing record {record_id} to blob storage: {str(e)}")
+            logger.error(f"Error uploading shard of {record_count} billing records to blob storage: {str(e)}")
             raise
     
-    def download_billing_record(self, record_id: str) -> Optional[Dict[str, Any]]:
-        """Download a billing record from blob storage"""
+    async def download_billing_record_by_path(self, blob_path: str, offset: Optional[int] = None, length: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Download a billing record from blob storage using a specific path, optionally a byte range within a shard"""
         try:
-            blob_name = f"{record_id}.json"
-            blob_client = self.container_client.get_blob_client(blob_name)
-            
-            # Download the blob content
-            blob_data = blob_client.download_blob()
-            content = blob_data.readall()
+            blob_client = self.container_client.get_blob_client(blob_path)
             
-            # Parse JSON content
-            record_data = json.loads(content.decode('utf-8'))
+            # Download and parse the blob content (only the record's range for shards)
+            record_data = await self._read_json_blob(blob_client, offset, length)
             
-            logger.info(f"Downloaded billing record from blob storage: {blob_name}")
+            logger.info(f"Downloaded billing record from blob storage: {blob_path}")
             return record_data
         except ResourceNotFoundError:
-            logger.warning(f"Billing record not found in blob storage: {record_id}")
+            logger.warning(f"Billing record not found in blob storage: {blob_path}")
             return None
         except Exception as e:
-            logger.error(f"Error downloading billing record {record_id} from blob storage: {str(e)}")
+            logger.error(f"Error downloading billing record from blob storage: {blob_path}, error: {str(e)}")
             raise
     
-    def download_billing_record_by_path(self, blob_path: str) -> Optional[Dict[str, Any]]:
-        """Download a billing record from blob storage using a specific path"""
+    async def delete_billing_record_by_path(self, blob_path: str) -> bool:
+        """Delete a billing record from blob storage using a specific path"""
         try:
             blob_client = self.container_client.get_blob_client(blob_path)
             
-            # Download the blob content
-            blob_data = blob_client.download_blob()
-            content = blob_data.readall()
-            
-            # Parse JSON content
-            record_data = json.loads(content.decode('utf-8'))
-            
-            logger.info(f"Downloaded billing record from blob storage: {blob_path}")
-            return record_data
+            await blob_client.delete_blob()
+            logger.info(f"Deleted billing record from blob storage: {blob_path}")
+            return True
         except ResourceNotFoundError:
-            logger.warning(f"Billing record not found in blob storage: {blob_path}")
-            return None
+            logger.warning(f"Record not found in blob storage for deletion: {blob_path}")
+            return False
         except Exception as e:
-            logger.error(f"Error downloading billing record from blob storage: {blob_path}, error: {str(e)}")
+            logger.error(f"Error deleting billing record from blob storage: {blob_path}, error: {str(e)}")
             raise
     
-    def delete_billing_record(self, record_id: str) -> bool:
-        """Delete a billing record from blob storage"""
+    @transient_retry
+    @blob_breaker
+    async def erase_shard_ranges(self, blob_path: str, extents: List[Tuple[int, int]]) -> bool:
+        """
+        Physically remove records from a shard by overwriting each (offset, length) with a
+        same-sized zstd skippable frame, so the remaining records keep their offsets.
+        Returns False if the shard does not exist.
+        """
         try:
-            blob_name = f"{record_id}.json"
-            blob_client = self.container_client.get_blob_client(blob_name)
+            blob_client = self.container_client.get_blob_client(blob_path)
             
-            blob_client.delete_blob()
-            logger.info(f"Deleted billing record from blob storage: {blob_name}")
-            return True
+            for attempt in range(SHARD_REWRITE_ATTEMPTS):
+                downloader = await blob_client.download_blob()
+                data = bytearray(await downloader.readall())
+                
+                for offset, length in extents:
+                    if offset + length > len(data):
+                        raise RuntimeError(f"Range {offset}+{length} is outside shard {blob_path} ({len(data)} bytes)")
+                    data[offset:offset + length] = struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, length - 8) + bytes(length - 8)
+                
+                try:
+                    # Only replace the shard version that was read; a concurrent erase re-reads and retries
+                    await blob_client.upload_blob(
+                        bytes(data),
+                        overwrite=True,
+                        etag=downloader.properties.etag,
+                        match_condition=MatchConditions.IfNotModified,
+                        # Fresh settings: the stored Content-MD5 no longer matches the rewritten bytes
+                        content_settings=ContentSettings(
+                            content_type=downloader.properties.content_settings.content_type,
+                            content_encoding=downloader.properties.content_settings.content_encoding
+                        ),
+                        metadata=downloader.properties.metadata,
+                        standard_blob_tier="Cool",
+                        max_concurrency=UPLOAD_MAX_CONCURRENCY
+                    )
+                except ResourceModifiedError:
+                    logger.warning(f"Shard {blob_path} changed while erasing records, retrying (attempt {attempt + 1})")
+                    continue
+                
+                logger.info(f"Erased {len(extents)} records from shard: {blob_path}")
+                return True
+            
+            raise RuntimeError(f"Shard {blob_path} kept changing; gave up erasing {len(extents)} records")
         except ResourceNotFoundError:
-            logger.warning(f"Record not found in blob storage for deletion: {record_id}")
+            logger.warning(f"Shard not found for erasing records: {blob_path}")
             return False
         except Exception as e:
-            logger.error(f"Error deleting billing record {record_id} from blob storage: {str(e)}")
+            logger.error(f"Error erasing records from shard {blob_path}: {str(e)}")
             raise
     
-    def blob_exists(self, record_id: str) -> bool:
-        """Check if a billing record exists in blob storage"""
+    async def delete_many(self, blob_paths: List[str]) -> List[bool]:
+        """Delete many blobs with the Blob Batch API; returns, per path, whether the blob is gone"""
+        gone: List[bool] = []
         try:
-            blob_name = f"{record_id}.json"
-            blob_client = self.container_client.get_blob_client(blob_name)
+            for start in range(0, len(blob_paths), BLOB_BATCH_LIMIT):
+                chunk = blob_paths[start:start + BLOB_BATCH_LIMIT]
+                
+                # One HTTP request per chunk; failures are reported per sub-request (in order) instead of raising.
+                # A blob that is already missing counts as deleted
+                responses = await self.container_client.delete_blobs(*chunk, raise_on_any_failure=False)
+                async for response in responses:
+                    gone.append(response.status_code in (202, 404))
             
-            return blob_client.exists()
+            logger.info(f"Deleted {sum(gone)} of {len(blob_paths)} billing records from blob storage")
+            return gone
         except Exception as e:
-            logger.error(f"Error checking if blob exists {record_id}: {str(e)}")
-            return False
+            logger.error(f"Error batch deleting billing records from blob storage: {str(e)}")
+            raise
     
-    def list_archived_records(self, prefix: Optional[str] = None) -> list:
+    async def list_archived_records(self, prefix: Optional[str] = None) -> list:
         """List all archived billing records"""
         try:
             blobs = []
-            for blob in self.container_client.list_blobs(name_starts_with=prefix):
+            async for blob in self.container_client.list_blobs(name_starts_with=prefix):
                 blobs.append(blob.name)
             
             logger.info(f"Found {len(blobs)} archived records")
@@ -10,14 +10,33 @@ class Config:
     COSMOS_DATABASE = os.getenv("COSMOS_DATABASE", "billingdb")
     COSMOS_CONTAINER = os.getenv("COSMOS_CONTAINER", "records")
     COSMOS_ARCHIVE_INDEX_CONTAINER = os.getenv("COSMOS_ARCHIVE_INDEX_CONTAINER", "archive_index")
+    COSMOS_COUNTERS_CONTAINER = os.getenv("COSMOS_COUNTERS_CONTAINER", "counters")
+    COSMOS_MAX_IN_FLIGHT = int(os.getenv("COSMOS_MAX_IN_FLIGHT", "100"))
     
     # Azure Blob Storage Configuration
     BLOB_CONNECTION_STRING = os.getenv("BLOB_CONNECTION_STRING")
     BLOB_CONTAINER = os.getenv("BLOB_CONTAINER", "billing-archive")
+    ZSTD_DICTIONARY_PATH = os.getenv("ZSTD_DICTIONARY_PATH", "")
     
     # Archival Configuration
     ARCHIVAL_DAYS_THRESHOLD = int(os.getenv("ARCHIVAL_DAYS_THRESHOLD", "90"))
     BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+    ARCHIVAL_PAGE_SIZE = int(os.getenv("ARCHIVAL_PAGE_SIZE", "1000"))
+    ARCHIVAL_CONCURRENCY = int(os.getenv("ARCHIVAL_CONCURRENCY", "32"))
+    
+    # Retry / Circuit Breaker Configuration
+    RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+    BREAKER_FAIL_MAX = int(os.getenv("BREAKER_FAIL_MAX", "20"))
+    BREAKER_RESET_TIMEOUT = int(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+    
+    # Archived Record Cache Configuration
+    ARCHIVE_CACHE_SIZE = int(os.getenv("ARCHIVE_CACHE_SIZE", "10000"))
+    ARCHIVE_CACHE_TTL = int(os.getenv("ARCHIVE_CACHE_TTL", "300"))
+    STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "30"))
+    NOT_FOUND_CACHE_TTL = int(os.getenv("NOT_FOUND_CACHE_TTL", "10"))
+    
+    # Skip re-validating documents that were already validated when they were written
+    TRUST_STORED_RECORDS = os.getenv("TRUST_STORED_RECORDS", "true").lower() == "true"
     
     # API Configuration
     API_HOST = os.getenv("API_HOST", "0.0.0.0")
@@ -1,48 +1,193 @@
-from azure.cosmos import CosmosClient, PartitionKey
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
-from typing import List, Optional, Dict, Any
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError
+from typing import AsyncIterator, List, Optional, Dict, Any, Set, Tuple, Type
+import aiohttp
+import asyncio
 import logging
 from config import Config
 from models import BillingRecord, ArchiveIndex
+from resilience import cosmos_breaker, cosmos_retry, cosmos_retry_attempts
 
 logger = logging.getLogger(__name__)
 
+# Id of the counter document that older versions kept inside each data
+# container, where the billing API could read, overwrite or delete it
+LEGACY_COUNTER_ID = "__count__"
+
+# Archived documents only carry the BillingRecord fields; system properties
+# (_rid, _self, _etag, _attachments, _ts) are not worth transferring or storing
+ARCHIVAL_PROJECTION = ", ".join(f'c["{name}"]' for name in BillingRecord.model_fields)
+
+# Records are only queried by created_at (archival range scan); every other
+# lookup is a point read, so indexing the remaining paths only costs write RUs
+RECORDS_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/created_at/?"}],
+    "excludedPaths": [{"path": "/*"}]
+}
+
+# Archive index entries are only ever point-read
+ARCHIVE_INDEX_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [],
+    "excludedPaths": [{"path": "/*"}]
+}
+
+# Counter documents are only ever point-read and patched
+COUNTERS_INDEXING_POLICY = ARCHIVE_INDEX_INDEXING_POLICY
+
+def _index_paths(indexing_policy: Dict[str, Any]) -> Tuple[Set[str], Set[str]]:
+    """Included and excluded paths of an indexing policy, ignoring the system-managed _etag exclusion"""
+    included = {path["path"] for path in indexing_policy.get("includedPaths", [])}
+    excluded = {path["path"] for path in indexing_policy.get("excludedPaths", []) if path["path"] != '/"_etag"/?'}
+    return included, excluded
+
+# Cosmos DB accepts at most 10 operations in a single patch request
+MAX_PATCH_OPERATIONS = 10
+
 class CosmosDBClient:
+    # (endpoint, database) pairs whose containers and counters are known to exist in this process
+    _ensured: Set[Tuple[str, str]] = set()
+    
     def __init__(self):
-        self.client = CosmosClient(Config.COSMOS_ENDPOINT, Config.COSMOS_KEY)
+        # Created in initialize(), since the aiohttp session must be bound to the running event loop
+        self.client = None
+        self.database = None
+        self.container = None
+        self.archive_index_container = None
+        self.counters_container = None
+    
+    async def initialize(self):
+        """Prepare the client for use (must be awaited once before other calls)"""
+        # One keep-alive connection pool shared by every request made through this client.
+        # Its size caps in-flight requests; callers beyond the limit wait for a free
+        # connection, so throttling (429s) stays bounded by the RU budget
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=Config.COSMOS_MAX_IN_FLIGHT, keepalive_timeout=60),
+            auto_decompress=False
+        )
+        self.client = CosmosClient(
+            Config.COSMOS_ENDPOINT,
+            Config.COSMOS_KEY,
+            consistency_level="Session",
+            transport=AioHttpTransport(session=session)
+        )
         self.database = self.client.get_database_client(Config.COSMOS_DATABASE)
         self.container = self.database.get_container_client(Config.COSMOS_CONTAINER)
         self.archive_index_container = self.database.get_container_client(Config.COSMOS_ARCHIVE_INDEX_CONTAINER)
+        self.counters_container = self.database.get_container_client(Config.COSMOS_COUNTERS_CONTAINER)
         
-        # Ensure containers exist
-        self._ensure_containers_exist()
+        # Container setup only has to happen once per process, however many clients are created
+        ensure_key = (Config.COSMOS_ENDPOINT, Config.COSMOS_DATABASE)
+        if ensure_key not in self._ensured:
+            await self._ensure_containers_exist()
+            await self._ensure_counter(self.container)
+            await self._ensure_counter(self.archive_index_container)
+            self._ensured.add(ensure_key)
     
-    def _ensure_containers_exist(self):
+    async def close(self):
+        """Close the underlying HTTP session"""
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+    
+    async def _ensure_containers_exist(self):
         """Ensure required containers exist in the database"""
+        # All containers are checked (and created if missing) concurrently
+        self.container, self.archive_index_container, self.counters_container = await asyncio.gather(
+            self._ensure_container(Config.COSMOS_CONTAINER, RECORDS_INDEXING_POLICY),
+            self._ensure_container(Config.COSMOS_ARCHIVE_INDEX_CONTAINER, ARCHIVE_INDEX_INDEXING_POLICY),
+            self._ensure_container(Config.COSMOS_COUNTERS_CONTAINER, COUNTERS_INDEXING_POLICY)
+        )
+    
+    async def _ensure_container(self, container_id: str, indexing_policy: Dict[str, Any]):
+        """Ensure a container exists with the expected indexing policy"""
+        container = await self.database.create_container_if_not_exists(
+            id=container_id,
+            partition_key=PartitionKey(path="/id"),
+            indexing_policy=indexing_policy
+        )
+        
+        # Containers created before the policy was introduced are updated in place (reindexed online)
+        properties = await container.read()
+        if _index_paths(properties.get("indexingPolicy", {})) != _index_paths(indexing_policy):
+            logger.info(f"Updating indexing policy of container: {container_id}")
+            container = await self.database.replace_container(
+                container,
+                partition_key=PartitionKey(path="/id"),
+                indexing_policy=indexing_policy
+            )
+        
+        return container
+    
+    async def _ensure_counter(self, container):
+        """Seed the counter document of a data container with a one-off COUNT query"""
+        # Counters live in their own container, keyed by the id of the container they count
         try:
-            # Check if main container exists
-            self.container.read()
+            await self.counters_container.read_item(item=container.id, partition_key=container.id)
+            return
         except CosmosResourceNotFoundError:
-            logger.info(f"Creating container: {Config.COSMOS_CONTAINER}")
-            self.database.create_container(
-                id=Config.COSMOS_CONTAINER,
-                partition_key=PartitionKey(path="/id")
-            )
+            pass
         
+        # Drop the counter document older versions stored among the data, so it is not counted
         try:
-            # Check if archive index container exists
-            self.archive_index_container.read()
+            await container.delete_item(item=LEGACY_COUNTER_ID, partition_key=LEGACY_COUNTER_ID)
+            logger.info(f"Removed legacy item counter from container: {container.id}")
         except CosmosResourceNotFoundError:
-            logger.info(f"Creating container: {Config.COSMOS_ARCHIVE_INDEX_CONTAINER}")
-            self.database.create_container(
-                id=Config.COSMOS_ARCHIVE_INDEX_CONTAINER,
-                partition_key=PartitionKey(path="/id")
+            pass
+        
+        counts = [count async for count in container.query_items(query="SELECT VALUE COUNT(1) FROM c")]
+        try:
+            await self.counters_container.create_item({"id": container.id, "value": counts[0] if counts else 0})
+            logger.info(f"Seeded item counter for container: {container.id}")
+        except CosmosResourceExistsError:
+            # Seeded concurrently by another instance
+            pass
+    
+    async def _increment_counter(self, container, delta: int):
+        """Atomically adjust the counter document of a data container"""
+        try:
+            await self.counters_container.patch_item(
+                item=container.id,
+                partition_key=container.id,
+                patch_operations=[{"op": "incr", "path": "/value", "value": delta}]
+            )
+        except Exception as e:
+            # The write itself succeeded; a drifting counter must not fail it
+            logger.warning(f"Error updating item counter for container {container.id}: {str(e)}")
+    
+    async def _read_counter(self, container) -> int:
+        """Read the counter of a data container, re-seeding it if it has gone missing"""
+        try:
+            counter = await self.counters_container.read_item(item=container.id, partition_key=container.id)
+        except CosmosResourceNotFoundError:
+            logger.warning(f"Item counter missing for container {container.id}, re-seeding")
+            await self._ensure_counter(container)
+            counter = await self.counters_container.read_item(item=container.id, partition_key=container.id)
+        return counter["value"]
+    
+    async def get_counts(self) -> Dict[str, int]:
+        """Get the number of billing records and archive index entries from the counter documents"""
+        try:
+            # Two independent single-partition point reads
+            records_count, archive_count = await asyncio.gather(
+                self._read_counter(self.container),
+                self._read_counter(self.archive_index_container)
             )
+            return {
+                "records": records_count,
+                "archive_index": archive_count
+            }
+        except Exception as e:
+            logger.error(f"Error reading item counters: {str(e)}")
+            raise
     
-    def get_billing_record(self, record_id: str) -> Optional[Dict[str, Any]]:
+    async def get_billing_record(self, record_id: str) -> Optional[Dict[str, Any]]:
         """Retrieve a billing record by ID"""
         try:
-            response = self.container.read_item(item=record_id, partition_key=record_id)
+            response = await self.container.read_item(item=record_id, partition_key=record_id)
             return response
         except CosmosResourceNotFoundError:
             logger.warning(f"Billing record not found in Cosmos DB: {record_id}")
@@ -51,29 +196,65 @@ class CosmosDBClient:
             logger.error(f"Error retrieving billing record {record_id}: {str(e)}")
             raise
     
-    def get_records_to_archive(self, cutoff_date: str) -> List[Dict[str, Any]]:
-        """Get records older than the cutoff date for archival"""
+    async def iter_record_pages_to_archive(self, cutoff_date: str, page_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yield pages of records older than the cutoff date as the query returns them"""
         try:
-            query = "SELECT * FROM c WHERE c.created_at < @cutoff"
+            query = f"SELECT {ARCHIVAL_PROJECTION} FROM c WHERE c.created_at < @cutoff"
             parameters = [{"name": "@cutoff", "value": cutoff_date}]
             
-            items = list(self.container.query_items(
+            pages = self.container.query_items(
                 query=query,
                 parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+                max_item_count=page_size
+            ).by_page()
             
-            logger.info(f"Found {len(items)} records to archive")
-            return items
+            async for page in pages:
+                records = [item async for item in page]
+                if records:
+                    yield records
         except Exception as e:
             logger.error(f"Error querying records for archival: {str(e)}")
             raise
     
-    def delete_record(self, record_id: str) -> bool:
+    async def count_records_to_archive(self, cutoff_date: str) -> int:
+        """Count the records older than the cutoff date without reading them"""
+        try:
+            # Aggregated on the service against the created_at index; only the number comes back
+            results = self.container.query_items(
+                query="SELECT VALUE COUNT(1) FROM c WHERE c.created_at < @cutoff",
+                parameters=[{"name": "@cutoff", "value": cutoff_date}]
+            )
+            counts = [count async for count in results]
+            return counts[0] if counts else 0
+        except Exception as e:
+            logger.error(f"Error counting records for archival: {str(e)}")
+            raise
+    
+    async def _retry_write(self, write, *args, already_applied: Tuple[Type[Exception], ...] = (), **kwargs):
+        """Run a write through the breaker, retrying transient errors"""
+        # Creates and deletes are not idempotent: when a response is lost, the retry finds the
+        # write already applied (409 on create, 404 on delete). That error is only raised when
+        # the first attempt gets it; on a retry it means the earlier attempt landed
+        async for attempt in cosmos_retry_attempts():
+            with attempt:
+                try:
+                    await cosmos_breaker.call_async(write, *args, **kwargs)
+                except already_applied as e:
+                    if attempt.retry_state.attempt_number == 1:
+                        raise
+                    logger.warning(f"Retried {write.__name__} was already applied: {str(e)}")
+    
+    async def delete_record(self, record_id: str) -> bool:
         """Delete a billing record from Cosmos DB"""
         try:
-            self.container.delete_item(item=record_id, partition_key=record_id)
-            logger.info(f"Deleted billing record: {record_id}")
+            await self._retry_write(
+                self.container.delete_item,
+                item=record_id,
+                partition_key=record_id,
+                already_applied=(CosmosResourceNotFoundError,)
+            )
+            await self._increment_counter(self.container, -1)
+            logger.debug("Deleted billing record: %s", record_id)
             return True
         except CosmosResourceNotFoundError:
             logger.warning(f"Record not found for deletion: {record_id}")
@@ -82,20 +263,53 @@ class CosmosDBClient:
             logger.error(f"Error deleting billing record {record_id}: {str(e)}")
             raise
     
-    def create_archive_index(self, archive_index: ArchiveIndex) -> bool:
-        """Create an archive index entry"""
+    async def create_archive_index(self, archive_index: ArchiveIndex) -> bool:
+        """Create or replace the archive index entry of a record"""
         try:
-            self.archive_index_container.create_item(archive_index.dict())
-            logger.info(f"Created archive index for record: {archive_index.id}")
+            body = archive_index.model_dump(mode="json")
+            try:
+                await self._retry_write(
+                    self.archive_index_container.create_item,
+                    body,
+                    already_applied=(CosmosResourceExistsError,)
+                )
+            except CosmosResourceExistsError:
+                # Left by an archival run that failed before deleting the record: point it at
+                # the new copy. The entry was already counted, so the counter stays as it is
+                await self._retry_write(self.archive_index_container.upsert_item, body)
+                logger.debug("Replaced archive index for record: %s", archive_index.id)
+                return True
+            
+            await self._increment_counter(self.archive_index_container, 1)
+            logger.debug("Created archive index for record: %s", archive_index.id)
             return True
         except Exception as e:
             logger.error(f"Error creating archive index for {archive_index.id}: {str(e)}")
             raise
     
-    def get_archive_index(self, record_id: str) -> Optional[Dict[str, Any]]:
+    async def delete_archive_index(self, record_id: str) -> bool:
+        """Delete the archive index entry for a record"""
+        try:
+            await self._retry_write(
+                self.archive_index_container.delete_item,
+                item=record_id,
+                partition_key=record_id,
+                already_applied=(CosmosResourceNotFoundError,)
+            )
+            await self._increment_counter(self.archive_index_container, -1)
+            logger.debug("Deleted archive index for record: %s", record_id)
+            return True
+        except CosmosResourceNotFoundError:
+            logger.warning(f"Archive index not found for deletion: {record_id}")
+            return False
+        except Exception as e:
+            logger.error(f"Error deleting archive index for {record_id}: {str(e)}")
+            raise
+    
+    async def get_archive_index(self, record_id: str) -> Optional[Dict[str, Any]]:
         """Get archive index entry for a record"""
         try:
-            response = self.archive_index_container.read_item(
+            response = await self.archive_index_container.read_item(
                 item=record_id, 
                 partition_key=record_id
             )
@@ -106,36 +320,66 @@ class CosmosDBClient:
             logger.error(f"Error retrieving archive index for {record_id}: {str(e)}")
             raise
     
-    def create_billing_record(self, record: BillingRecord) -> bool:
+    async def get_record_or_archive(self, record_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Read a billing record and its archive index entry concurrently; either may be None"""
+        return await asyncio.gather(
+            self.get_billing_record(record_id),
+            self.get_archive_index(record_id)
+        )
+    
+    async def create_billing_record(self, record: BillingRecord) -> bool:
         """Create a new billing record"""
         try:
-            self.container.create_item(record.dict())
-            logger.info(f"Created billing record: {record.id}")
+            await self._retry_write(
+                self.container.create_item,
+                record.model_dump(mode="json"),
+                already_applied=(CosmosResourceExistsError,)
+            )
+            await self._increment_counter(self.container, 1)
+            logger.debug("Created billing record: %s", record.id)
             return True
         except Exception as e:
             logger.error(f"Error creating billing record {record.id}: {str(e)}")
             raise
     
-    def update_billing_record(self, record_id: str, updates: Dict[str, Any]) -> bool:
-        """Update an existing billing record"""
+    @cosmos_retry
+    @cosmos_breaker
+    async def update_billing_record(self, record_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Update an existing billing record and return the stored document"""
         try:
-            # First get the existing record
-            existing_record = self.get_billing_record(record_id)
+            if not updates:
+                return await self.get_billing_record(record_id)
+            
+            if len(updates) <= MAX_PATCH_OPERATIONS:
+                # Send only the changed fields; the service echoes back the patched document
+                updated_record = await self.container.patch_item(
+                    item=record_id,
+                    partition_key=record_id,
+                    patch_operations=[{"op": "set", "path": f"/{key}", "value": value} for key, value in updates.items()]
+                )
+                logger.debug("Updated billing record: %s", record_id)
+                return updated_record
+            
+            # Too many fields for one patch: fall back to read-modify-write
+            existing_record = await self.get_billing_record(record_id)
             if not existing_record:
-                return False
+                return None
             
             # Update with new values
             existing_record.update(updates)
             
-            # Replace the record
-            self.container.replace_item(
+            # Replace the record; the service echoes back the stored document
+            updated_record = await self.container.replace_item(
                 item=record_id,
                 body=existing_record,
                 partition_key=record_id
             )
             
-            logger.info(f"Updated billing record: {record_id}")
-            return True
+            logger.debug("Updated billing record: %s", record_id)
+            return updated_record
+        except CosmosResourceNotFoundError:
+            logger.warning(f"Billing record not found for update: {record_id}")
+            return None
         except Exception as e:
             logger.error(f"Error updating billing record {record_id}: {str(e)}")
             raise 
\ No newline at end of file
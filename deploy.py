@@ -7,7 +7,9 @@ This script helps set up and validate the system configuration
 import os
 import sys
 import json
+import re
 import subprocess
+from importlib.metadata import PackageNotFoundError, distribution
 from pathlib import Path
 from typing import Dict, Any, Optional
 
@@ -19,25 +21,30 @@ def check_python_version():
     print(f"✅ Python {sys.version_info.major}.{sys.version_info.minor} detected")
     return True
 
+def read_requirements() -> Dict[str, str]:
+    """Map each package in requirements.txt to its full (pinned) requirement line"""
+    requirements = {}
+    for line in Path(__file__).with_name("requirements.txt").read_text().splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            # The distribution name ends at the first extras, version or marker character
+            requirements[re.split(r"[\[=<>!~;\s]", line, 1)[0]] = line
+    return requirements
+
 def check_dependencies():
     """Check if required dependencies are installed"""
-    required_packages = [
-        "azure-cosmos",
-        "azure-storage-blob", 
-        "fastapi",
-        "uvicorn",
-        "pydantic",
-        "python-dotenv"
-    ]
+    # requirements.txt is the single list of runtime dependencies
+    required_packages = read_requirements()
     
     missing_packages = []
     
     for package in required_packages:
         try:
-            __import__(package.replace("-", "_"))
+            # Only reads the installed package metadata; nothing is imported
+            distribution(package)
             print(f"✅ {package} is installed")
-        except ImportError:
-            missing_packages.append(package)
+        except PackageNotFoundError:
+            missing_packages.append(required_packages[package])
             print(f"❌ {package} is missing")
     
     if missing_packages:
@@ -105,18 +112,25 @@ def validate_azure_credentials():
     print("\n🔐 Validating Azure Credentials...")
     
     try:
+        import asyncio
         from config import Config
         from cosmos_client import CosmosDBClient
         from blob_client import BlobStorageClient
         
+        async def check_connection(client):
+            try:
+                await client.initialize()
+            finally:
+                await client.close()
+        
         # Test Cosmos DB connection
         print("Testing Cosmos DB connection...")
-        cosmos_client = CosmosDBClient()
+        asyncio.run(check_connection(CosmosDBClient()))
         print("✅ Cosmos DB connection successful")
         
         # Test Blob Storage connection
         print("Testing Blob Storage connection...")
-        blob_client = BlobStorageClient()
+        asyncio.run(check_connection(BlobStorageClient()))
         print("✅ Blob Storage connection successful")
         
         return True
@@ -131,24 +145,43 @@ def create_sample_data():
     
     try:
         import requests
-        from datetime import datetime, timedelta
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import datetime, timedelta, timezone
         
         base_url = "http://localhost:8000"
         
+        # One session, so the health checks and inserts reuse the same connections
+        session = requests.Session()
+        
         # Wait for API to be ready
         print("Waiting for API to be ready...")
-        for i in range(30):  # Wait up to 30 seconds
+        deadline = time.monotonic() + 30  # Wait up to 30 seconds
+        attempt = 0
+        while True:
             try:
-                response = requests.get(f"{base_url}/health", timeout=5)
+                response = session.get(f"{base_url}/health", timeout=5)
                 if response.status_code == 200:
                     print("✅ API is ready")
                     break
-            except:
-                if i == 29:
-                    print("❌ API is not responding")
-                    return False
-                import time
-                time.sleep(1)
+            except requests.RequestException:
+                pass
+            
+            if time.monotonic() >= deadline:
+                print("❌ API is not responding")
+                session.close()
+                return False
+            
+            # Poll quickly at first, backing off to at most 2s between attempts
+            time.sleep(min(2.0, 0.05 * 2 ** attempt))
+            attempt += 1
+        
+        # One clock read for every sample timestamp. Naive UTC, matching the
+        # timestamps the API and the archival cutoff use
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        
+        def days_ago(days):
+            return (now - timedelta(days=days)).isoformat()
         
         # Create sample records
         sample_records = [
@@ -158,9 +191,9 @@ def create_sample_data():
                 "currency": "USD",
                 "status": "paid",
                 "description": "Monthly subscription",
-                "created_at": (datetime.utcnow() - timedelta(days=30)).isoformat(),
-                "due_date": (datetime.utcnow() - timedelta(days=5)).isoformat(),
-                "paid_at": (datetime.utcnow() - timedelta(days=3)).isoformat()
+                "created_at": days_ago(30),
+                "due_date": days_ago(5),
+                "paid_at": days_ago(3)
             },
             {
                 "customer_id": "customer-002", 
@@ -168,8 +201,8 @@ def create_sample_data():
                 "currency": "USD",
                 "status": "pending",
                 "description": "Annual subscription",
-                "created_at": (datetime.utcnow() - timedelta(days=100)).isoformat(),
-                "due_date": (datetime.utcnow() - timedelta(days=70)).isoformat()
+                "created_at": days_ago(100),
+                "due_date": days_ago(70)
             },
             {
                 "customer_id": "customer-003",
@@ -177,14 +210,14 @@ def create_sample_data():
                 "currency": "USD", 
                 "status": "overdue",
                 "description": "Quarterly subscription",
-                "created_at": (datetime.utcnow() - timedelta(days=95)).isoformat(),
-                "due_date": (datetime.utcnow() - timedelta(days=65)).isoformat()
+                "created_at": days_ago(95),
+                "due_date": days_ago(65)
             }
         ]
         
-        for i, record in enumerate(sample_records, 1):
+        def post_record(i, record):
             try:
-                response = requests.post(
+                response = session.post(
                     f"{base_url}/billing",
                     json=record,
                     headers={"Content-Type": "application/json"}
@@ -198,6 +231,11 @@ def create_sample_data():
             except Exception as e:
                 print(f"❌ Error creating sample record {i}: {e}")
         
+        # The inserts are independent, so send them in parallel
+        with ThreadPoolExecutor(max_workers=len(sample_records)) as executor:
+            list(executor.map(post_record, range(1, len(sample_records) + 1), sample_records))
+        
+        session.close()
         return True
         
     except Exception as e:
@@ -5,29 +5,36 @@ Deploy blob storage lifecycle management policy for cost optimization
 
 import json
 import os
-import subprocess
+import re
 import sys
 from pathlib import Path
 
+def _find_resource_group(storage_client, storage_account: str):
+    """Find the resource group of a storage account in the current subscription"""
+    for account in storage_client.storage_accounts.list():
+        if account.name == storage_account:
+            # Account ids look like /subscriptions/<id>/resourceGroups/<group>/providers/...
+            match = re.search(r"/resourceGroups/([^/]+)/", account.id, re.IGNORECASE)
+            return match.group(1) if match else None
+    return None
+
 def deploy_lifecycle_policy():
     """Deploy the blob storage lifecycle management policy"""
     
-    # Check if Azure CLI is installed
+    # The management SDK talks to Azure directly; no Azure CLI processes are spawned
     try:
-        subprocess.run(["az", "--version"], capture_output=True, check=True)
-        print("✅ Azure CLI is installed")
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        print("❌ Azure CLI is not installed. Please install it first.")
-        print("   Visit: https://docs.microsoft.com/en-us/cli/azure/install-azure-cli")
+        from azure.core.exceptions import ClientAuthenticationError, HttpResponseError
+        from azure.identity import DefaultAzureCredential
+        from azure.mgmt.storage import StorageManagementClient
+        from azure.mgmt.storage.models import ManagementPolicy
+    except ImportError:
+        print("❌ azure-identity and azure-mgmt-storage are required. Install them with:")
+        print("   pip install azure-identity azure-mgmt-storage")
         return False
     
-    # Check if logged in to Azure
-    try:
-        result = subprocess.run(["az", "account", "show"], capture_output=True, text=True, check=True)
-        account_info = json.loads(result.stdout)
-        print(f"✅ Logged in to Azure as: {account_info.get('user', {}).get('name', 'Unknown')}")
-    except subprocess.CalledProcessError:
-        print("❌ Not logged in to Azure. Please run 'az login' first.")
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    if not subscription_id:
+        print("❌ AZURE_SUBSCRIPTION_ID environment variable not set")
         return False
     
     # Get storage account name from environment
@@ -38,13 +45,11 @@ def deploy_lifecycle_policy():
     
     # Extract storage account name from connection string
     try:
-        for part in connection_string.split(";"):
-            if part.startswith("AccountName="):
-                storage_account = part.split("=")[1]
-                break
-        else:
+        match = re.search(r"(?:^|;)AccountName=([^;]+)", connection_string)
+        if not match:
             print("❌ Could not extract storage account name from connection string")
             return False
+        storage_account = match.group(1)
     except Exception as e:
         print(f"❌ Error parsing connection string: {e}")
         return False
@@ -67,34 +72,32 @@ def deploy_lifecycle_policy():
     
     # Deploy the policy
     try:
-        print("🚀 Deploying lifecycle management policy...")
-        
-        # Create temporary policy file with proper format
-        temp_policy = {
-            "rules": policy["rules"]
-        }
+        # Environment, managed identity or cached Azure CLI / VS Code credentials
+        credential = DefaultAzureCredential()
+        storage_client = StorageManagementClient(credential, subscription_id)
         
-        with open("temp_policy.json", 'w') as f:
-            json.dump(temp_policy, f, indent=2)
-        
-        # Deploy using Azure CLI
-        cmd = [
-            "az", "storage", "account", "management-policy", "create",
-            "--account-name", storage_account,
-            "--policy", "temp_policy.json"
-        ]
+        resource_group = os.getenv("AZURE_RESOURCE_GROUP") or _find_resource_group(storage_client, storage_account)
+        if not resource_group:
+            print(f"❌ Storage account {storage_account} not found in subscription {subscription_id}")
+            return False
+        print(f"📁 Resource Group: {resource_group}")
         
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        print("🚀 Deploying lifecycle management policy...")
+        storage_client.management_policies.create_or_update(
+            resource_group,
+            storage_account,
+            "default",
+            ManagementPolicy.from_dict({"policy": {"rules": policy["rules"]}})
+        )
         print("✅ Lifecycle management policy deployed successfully")
         
-        # Clean up temporary file
-        Path("temp_policy.json").unlink(missing_ok=True)
-        
         return True
         
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to deploy policy: {e}")
-        print(f"Error output: {e.stderr}")
+    except ClientAuthenticationError as e:
+        print(f"❌ Could not authenticate to Azure. Run 'az login' or set service principal credentials: {e}")
+        return False
+    except HttpResponseError as e:
+        print(f"❌ Failed to deploy policy: {e.message}")
         return False
     except Exception as e:
         print(f"❌ Error deploying policy: {e}")
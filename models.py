@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 from enum import Enum
 
@@ -10,6 +10,10 @@ class BillingStatus(str, Enum):
     CANCELLED = "cancelled"
 
 class BillingRecord(BaseModel):
+    # Immutable once validated, so instances can be shared safely between tasks;
+    # status is stored as its plain string value, skipping enum lookups on serialization
+    model_config = ConfigDict(frozen=True, use_enum_values=True)
+    
     id: str = Field(..., description="Unique identifier for the billing record")
     customer_id: str = Field(..., description="Customer identifier")
     amount: float = Field(..., description="Billing amount")
@@ -20,22 +24,14 @@ class BillingRecord(BaseModel):
     due_date: datetime = Field(..., description="Payment due date")
     paid_at: Optional[datetime] = Field(None, description="Payment timestamp")
     metadata: Optional[Dict[str, Any]] = Field(default_factory=dict, description="Additional metadata")
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
 
 class ArchiveIndex(BaseModel):
     id: str = Field(..., description="Billing record ID")
     blob_path: str = Field(..., description="Path to the archived blob")
+    offset: Optional[int] = Field(None, description="Byte offset of the record within a shard blob")
+    length: Optional[int] = Field(None, description="Byte length of the record within a shard blob")
     archived_at: datetime = Field(..., description="When the record was archived")
     original_created_at: datetime = Field(..., description="Original creation date")
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
 
 class BillingResponse(BaseModel):
     success: bool = Field(..., description="Operation success status")
@@ -46,4 +42,11 @@ class BillingResponse(BaseModel):
 class ArchiveResponse(BaseModel):
     success: bool = Field(..., description="Operation success status")
     archived_count: int = Field(..., description="Number of records archived")
-    message: str = Field(..., description="Response message") 
\ No newline at end of file
+    message: str = Field(..., description="Response message")
+
+class BillingBatchResponse(BaseModel):
+    success: bool = Field(..., description="Operation success status")
+    records: List[BillingResponse] = Field(default_factory=list, description="Per-record results")
+    missing: List[str] = Field(default_factory=list, description="IDs that were not found or could not be created")
+    errors: List[str] = Field(default_factory=list, description="IDs whose stored record is invalid")
+    message: Optional[str] = Field(None, description="Response message") 
\ No newline at end of file
@@ -0,0 +1,60 @@
+from datetime import timedelta
+import logging
+from aiobreaker import CircuitBreaker
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from tenacity import AsyncRetrying, before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Throttling, timeouts and server-side failures are worth retrying; anything
+# else (404, 409, 400, ...) is an answer, not an outage
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether an Azure SDK error is likely to succeed when retried"""
+    if isinstance(exc, (ServiceRequestError, ServiceResponseError)):
+        return True
+    return isinstance(exc, HttpResponseError) and exc.status_code in TRANSIENT_STATUS_CODES
+
+def is_cosmos_transient(exc: BaseException) -> bool:
+    """Whether a Cosmos DB error is worth retrying on top of the SDK's own retries"""
+    # The SDK already retries throttled requests itself, honouring the service's retry-after
+    if isinstance(exc, HttpResponseError) and exc.status_code == 429:
+        return False
+    return is_transient(exc)
+
+def _is_not_transient(exc: BaseException) -> bool:
+    return not is_transient(exc)
+
+def _breaker(name: str) -> CircuitBreaker:
+    # Only transient failures trip the breaker; not-found and conflict errors are expected
+    return CircuitBreaker(
+        fail_max=Config.BREAKER_FAIL_MAX,
+        timeout_duration=timedelta(seconds=Config.BREAKER_RESET_TIMEOUT),
+        exclude=[_is_not_transient],
+        name=name
+    )
+
+# Process-wide breakers, one per backing service, so an outage of one does not shed load on the other
+cosmos_breaker = _breaker("cosmos_db")
+blob_breaker = _breaker("blob_storage")
+
+def _retry_policy(predicate) -> dict:
+    # Exponential backoff (2s, 4s, 8s, ... capped at 30s) on the errors the predicate accepts
+    return dict(
+        wait=wait_exponential(multiplier=2, max=30),
+        stop=stop_after_attempt(Config.RETRY_MAX_ATTEMPTS),
+        retry=retry_if_exception(predicate),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    )
+
+# Retry decorators, applied outside the breaker so an open breaker fails fast instead of being retried.
+# Only use them on idempotent operations: a retried write may already have been applied.
+transient_retry = retry(**_retry_policy(is_transient))
+cosmos_retry = retry(**_retry_policy(is_cosmos_transient))
+
+def cosmos_retry_attempts() -> AsyncRetrying:
+    """Retry loop for Cosmos DB writes that need to know which attempt they are on"""
+    return AsyncRetrying(**_retry_policy(is_cosmos_transient))
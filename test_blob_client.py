@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Unit tests for erasing records from blob shards, run against a stubbed blob container
+"""
+
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import orjson
+
+from azure.core.exceptions import ResourceModifiedError, ServiceResponseError
+
+from blob_client import BlobStorageClient, ZstdDictionaryMissingError, ZSTD_DICT_METADATA_KEY
+
+class _Downloader:
+    """Stand-in for the SDK's StorageStreamDownloader"""
+    def __init__(self, data, properties, offset=None, length=None):
+        end = None if length is None else (offset or 0) + length
+        self._data = data[offset or 0:end]
+        self.properties = properties
+    
+    async def readall(self):
+        return self._data
+    
+    def chunks(self):
+        return self._chunks()
+    
+    async def _chunks(self):
+        yield self._data
+
+class _StubBlob:
+    """Single blob with an ETag that changes on every write"""
+    def __init__(self, data, conflicts=0):
+        self.data = data
+        self.version = 1
+        self.conflicts = conflicts
+        self.uploads = []
+    
+    def _properties(self):
+        return SimpleNamespace(
+            etag=f'"{self.version}"',
+            content_settings=SimpleNamespace(content_type="application/x-ndjson", content_encoding="zstd", content_md5=b"stale"),
+            metadata={}
+        )
+    
+    async def download_blob(self, offset=None, length=None):
+        return _Downloader(self.data, self._properties(), offset, length)
+    
+    async def upload_blob(self, data, **kwargs):
+        if self.conflicts:
+            # Another writer got there first
+            self.conflicts -= 1
+            self.version += 1
+            raise ResourceModifiedError("etag mismatch")
+        self.last_etag = kwargs["etag"]
+        self.data = data
+        self.version += 1
+        self.uploads.append(kwargs)
+
+class _StubContainer:
+    def __init__(self, blob):
+        self.blob = blob
+    
+    def get_blob_client(self, blob_path):
+        return self.blob
+
+class EraseShardRangesTest(unittest.IsolatedAsyncioTestCase):
+    def _client(self, blob):
+        client = BlobStorageClient.__new__(BlobStorageClient)
+        client.container_client = _StubContainer(blob)
+        return client
+    
+    def _shard(self, records):
+        return BlobStorageClient._encode_shard(records)
+    
+    async def test_erased_record_is_gone_and_neighbours_still_read(self):
+        data, extents = self._shard([{"id": "a"}, {"id": "b"}, {"id": "c"}])
+        blob = _StubBlob(data)
+        client = self._client(blob)
+        
+        self.assertTrue(await client.erase_shard_ranges("shard", [extents[1]]))
+        
+        # Same size, so the other records keep their offsets
+        self.assertEqual(len(blob.data), len(data))
+        self.assertNotIn(b'"b"', blob.data)
+        self.assertIsNone(await client.download_billing_record_by_path("shard", *extents[1]))
+        self.assertEqual(await client.download_billing_record_by_path("shard", *extents[0]), {"id": "a"})
+        self.assertEqual(await client.download_billing_record_by_path("shard", *extents[2]), {"id": "c"})
+        
+        # Stored MD5 of the old bytes is not carried over
+        self.assertIsNone(blob.uploads[0]["content_settings"].content_md5)
+    
+    async def test_rereads_the_shard_when_it_changed_concurrently(self):
+        data, extents = self._shard([{"id": "a"}, {"id": "b"}])
+        blob = _StubBlob(data, conflicts=2)
+        
+        self.assertTrue(await self._client(blob).erase_shard_ranges("shard", extents))
+        
+        self.assertEqual(len(blob.uploads), 1)
+        self.assertEqual(blob.last_etag, '"3"')
+    
+    async def test_rejects_ranges_outside_the_shard(self):
+        data, _ = self._shard([{"id": "a"}])
+        
+        with self.assertRaises(RuntimeError):
+            await self._client(_StubBlob(data)).erase_shard_ranges("shard", [(len(data), 16)])
+
+class UploadShardTest(unittest.IsolatedAsyncioTestCase):
+    async def test_retry_after_a_lost_response_rewrites_the_same_shard(self):
+        class FlakyContainer:
+            def __init__(self):
+                self.puts = []
+            
+            def get_blob_client(self, blob_name):
+                container = self
+                
+                class Blob:
+                    async def upload_blob(self, data, **kwargs):
+                        container.puts.append((blob_name, kwargs["overwrite"]))
+                        if len(container.puts) == 1:
+                            # The write landed, but the response never made it back
+                            raise ServiceResponseError("connection reset")
+                
+                return Blob()
+        
+        client = BlobStorageClient.__new__(BlobStorageClient)
+        client.container_client = FlakyContainer()
+        
+        # Skip the retry backoff
+        with patch.object(BlobStorageClient._put_shard.retry, "sleep", new=AsyncMock()):
+            blob_name, extents = await client.upload_billing_records_shard([{"id": "a"}, {"id": "b"}])
+        
+        self.assertEqual(client.container_client.puts, [(blob_name, True), (blob_name, True)])
+        self.assertEqual(len(extents), 2)
+
+class DeleteManyTest(unittest.IsolatedAsyncioTestCase):
+    async def test_reports_each_blob_in_order(self):
+        statuses = {"deleted": 202, "missing": 404, "locked": 409}
+        
+        class BatchContainer:
+            async def delete_blobs(self, *blob_paths, raise_on_any_failure):
+                async def responses():
+                    for path in blob_paths:
+                        yield SimpleNamespace(status_code=statuses[path])
+                return responses()
+        
+        client = BlobStorageClient.__new__(BlobStorageClient)
+        client.container_client = BatchContainer()
+        
+        self.assertEqual(await client.delete_many(["deleted", "locked", "missing"]), [True, False, True])
+
+class EncodeShardTest(unittest.TestCase):
+    def test_each_extent_is_one_record(self):
+        records = [
+            {"id": "a", "amount": 1.5, "created_at": datetime(2024, 1, 2, 3, 4, 5)},
+            {"id": "b", "amount": 2.0, "created_at": "2024-02-03T04:05:06"}
+        ]
+        
+        data, extents = BlobStorageClient._encode_shard(records)
+        
+        decoded = [
+            orjson.loads(BlobStorageClient._decompressor.decompress(data[offset:offset + length]))
+            for offset, length in extents
+        ]
+        self.assertEqual(decoded, [
+            {"id": "a", "amount": 1.5, "created_at": "2024-01-02T03:04:05+00:00"},
+            {"id": "b", "amount": 2.0, "created_at": "2024-02-03T04:05:06"}
+        ])
+        self.assertEqual(sum(length for _, length in extents), len(data))
+
+class DecompressorForTest(unittest.TestCase):
+    def test_unknown_dictionary_is_a_configuration_error(self):
+        client = BlobStorageClient.__new__(BlobStorageClient)
+        
+        with self.assertRaises(ZstdDictionaryMissingError) as raised:
+            client._decompressor_for({ZSTD_DICT_METADATA_KEY: "12345"})
+        
+        # Not a ValueError, which the API reports as a missing record
+        self.assertNotIsInstance(raised.exception, ValueError)
+    
+    def test_blobs_without_a_dictionary_use_the_plain_decompressor(self):
+        client = BlobStorageClient.__new__(BlobStorageClient)
+        
+        self.assertIs(client._decompressor_for({}), BlobStorageClient._decompressor)
+
+if __name__ == "__main__":
+    unittest.main() 
\ No newline at end of file
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the Cosmos DB client's archival queries, item counters and write retries, run against stubbed containers
+"""
+
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from azure.core.exceptions import ServiceResponseError
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosResourceNotFoundError
+from tenacity import wait_none
+
+from cosmos_client import CosmosDBClient, LEGACY_COUNTER_ID
+from models import ArchiveIndex, BillingRecord
+from resilience import cosmos_retry_attempts
+
+class _Page:
+    """One page of query results, iterated asynchronously like the SDK's pages"""
+    def __init__(self, items):
+        self._items = items
+    
+    def __aiter__(self):
+        return self._iter()
+    
+    async def _iter(self):
+        for item in self._items:
+            yield item
+
+class _Pager:
+    """Stand-in for the AsyncItemPaged returned by query_items"""
+    def __init__(self, pages):
+        self._pages = pages
+    
+    def by_page(self):
+        return self._iter()
+    
+    async def _iter(self):
+        for page in self._pages:
+            yield _Page(page)
+
+class _StubContainer:
+    """Container that records its query arguments and serves fixed pages"""
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+    
+    def query_items(self, **kwargs):
+        self.calls.append(kwargs)
+        return _Pager(self.pages)
+
+class IterRecordPagesToArchiveTest(unittest.IsolatedAsyncioTestCase):
+    def _client(self, container):
+        client = CosmosDBClient()
+        client.container = container
+        return client
+    
+    async def test_yields_each_non_empty_page(self):
+        container = _StubContainer([[{"id": "a"}, {"id": "b"}], [], [{"id": "c"}]])
+        
+        pages = [page async for page in self._client(container).iter_record_pages_to_archive("2024-01-01T00:00:00", 2)]
+        
+        self.assertEqual(pages, [[{"id": "a"}, {"id": "b"}], [{"id": "c"}]])
+    
+    async def test_runs_one_parameterised_query(self):
+        container = _StubContainer([])
+        
+        pages = [page async for page in self._client(container).iter_record_pages_to_archive("2024-01-01T00:00:00", 500)]
+        
+        self.assertEqual(pages, [])
+        self.assertEqual(len(container.calls), 1)
+        call = container.calls[0]
+        self.assertIn("c.created_at < @cutoff", call["query"])
+        self.assertEqual(call["parameters"], [{"name": "@cutoff", "value": "2024-01-01T00:00:00"}])
+        self.assertEqual(call["max_item_count"], 500)
+        self.assertNotIn("feed_range", call)
+    
+    async def test_propagates_query_errors(self):
+        class FailingContainer:
+            def query_items(self, **kwargs):
+                raise RuntimeError("query failed")
+        
+        with self.assertRaises(RuntimeError):
+            async for _ in self._client(FailingContainer()).iter_record_pages_to_archive("2024-01-01T00:00:00"):
+                pass
+
+class CountRecordsToArchiveTest(unittest.IsolatedAsyncioTestCase):
+    async def test_counts_on_the_service(self):
+        class CountingContainer:
+            def __init__(self):
+                self.calls = []
+            
+            def query_items(self, **kwargs):
+                self.calls.append(kwargs)
+                return _Page([42])
+        
+        container = CountingContainer()
+        client = CosmosDBClient()
+        client.container = container
+        
+        self.assertEqual(await client.count_records_to_archive("2024-01-01T00:00:00"), 42)
+        self.assertEqual(container.calls, [{
+            "query": "SELECT VALUE COUNT(1) FROM c WHERE c.created_at < @cutoff",
+            "parameters": [{"name": "@cutoff", "value": "2024-01-01T00:00:00"}]
+        }])
+
+class _ItemContainer:
+    """Container holding items in a dict, with the point operations the counters use"""
+    def __init__(self, container_id, items=None):
+        self.id = container_id
+        self.items = {item["id"]: dict(item) for item in items or []}
+    
+    async def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(message=f"{item} not found")
+        return dict(self.items[item])
+    
+    async def create_item(self, body):
+        if body["id"] in self.items:
+            raise CosmosResourceExistsError(message=f"{body['id']} exists")
+        self.items[body["id"]] = dict(body)
+        return dict(body)
+    
+    async def delete_item(self, item, partition_key):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(message=f"{item} not found")
+        del self.items[item]
+    
+    async def patch_item(self, item, partition_key, patch_operations):
+        for operation in patch_operations:
+            self.items[item]["value"] += operation["value"]
+    
+    async def upsert_item(self, body):
+        self.items[body["id"]] = dict(body)
+        return dict(body)
+    
+    def query_items(self, query, **kwargs):
+        # Only the seeding COUNT query is issued against these containers
+        return _Page([len(self.items)])
+
+class _LostResponseContainer(_ItemContainer):
+    """Container whose first create or delete lands but loses its response"""
+    def __init__(self, container_id, items=None):
+        super().__init__(container_id, items)
+        self.writes = 0
+    
+    async def create_item(self, body):
+        self.writes += 1
+        result = await super().create_item(body)
+        if self.writes == 1:
+            raise ServiceResponseError("connection reset")
+        return result
+    
+    async def delete_item(self, item, partition_key):
+        self.writes += 1
+        await super().delete_item(item, partition_key)
+        if self.writes == 1:
+            raise ServiceResponseError("connection reset")
+
+class ItemCountersTest(unittest.IsolatedAsyncioTestCase):
+    def _client(self, records, archive_index):
+        client = CosmosDBClient()
+        client.container = _ItemContainer("records", records)
+        client.archive_index_container = _ItemContainer("archive_index", archive_index)
+        client.counters_container = _ItemContainer("counters")
+        return client
+    
+    async def test_counters_live_outside_the_data_containers(self):
+        client = self._client([{"id": "a"}, {"id": "b"}], [{"id": "c"}])
+        await client._ensure_counter(client.container)
+        await client._ensure_counter(client.archive_index_container)
+        
+        await client._increment_counter(client.container, 1)
+        
+        self.assertEqual(await client.get_counts(), {"records": 3, "archive_index": 1})
+        self.assertEqual(set(client.container.items), {"a", "b"})
+    
+    async def test_legacy_counter_document_is_removed_and_not_counted(self):
+        client = self._client([{"id": "a"}, {"id": LEGACY_COUNTER_ID, "value": 1}], [])
+        
+        await client._ensure_counter(client.container)
+        
+        self.assertNotIn(LEGACY_COUNTER_ID, client.container.items)
+        self.assertEqual(client.counters_container.items["records"]["value"], 1)
+    
+    async def test_missing_counter_is_reseeded_on_read(self):
+        client = self._client([{"id": "a"}], [])
+        
+        self.assertEqual(await client.get_counts(), {"records": 1, "archive_index": 0})
+        self.assertEqual(set(client.counters_container.items), {"records", "archive_index"})
+
+class RetriedWriteTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Skip the retry backoff
+        patcher = patch("cosmos_client.cosmos_retry_attempts", lambda: cosmos_retry_attempts().copy(wait=wait_none()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def _client(self, container, archive_index_container):
+        client = CosmosDBClient()
+        client.container = container
+        client.archive_index_container = archive_index_container
+        client.counters_container = _ItemContainer("counters", [
+            {"id": "records", "value": len(container.items)},
+            {"id": "archive_index", "value": len(archive_index_container.items)}
+        ])
+        return client
+    
+    def _archive_index(self, blob_path):
+        return ArchiveIndex(id="a", blob_path=blob_path, archived_at=datetime(2024, 6, 1), original_created_at=datetime(2024, 1, 1))
+    
+    async def test_create_whose_response_was_lost_counts_once(self):
+        container = _LostResponseContainer("records")
+        client = self._client(container, _ItemContainer("archive_index"))
+        record = BillingRecord(id="a", customer_id="c", amount=1.0, status="pending", created_at=datetime(2024, 1, 1), due_date=datetime(2024, 2, 1))
+        
+        self.assertTrue(await client.create_billing_record(record))
+        
+        self.assertEqual(container.writes, 2)
+        self.assertEqual((await client.get_counts())["records"], 1)
+    
+    async def test_delete_whose_response_was_lost_counts_once(self):
+        archive_index_container = _LostResponseContainer("archive_index", [{"id": "a"}])
+        client = self._client(_ItemContainer("records"), archive_index_container)
+        
+        self.assertTrue(await client.delete_archive_index("a"))
+        
+        self.assertEqual(archive_index_container.writes, 2)
+        self.assertEqual((await client.get_counts())["archive_index"], 0)
+    
+    async def test_first_attempt_not_found_is_still_reported(self):
+        client = self._client(_ItemContainer("records"), _ItemContainer("archive_index"))
+        
+        self.assertFalse(await client.delete_record("missing"))
+    
+    async def test_leftover_archive_index_is_replaced_without_counting_it_again(self):
+        archive_index_container = _ItemContainer("archive_index", [self._archive_index("old").model_dump(mode="json")])
+        client = self._client(_ItemContainer("records"), archive_index_container)
+        
+        self.assertTrue(await client.create_archive_index(self._archive_index("new")))
+        
+        self.assertEqual(archive_index_container.items["a"]["blob_path"], "new")
+        self.assertEqual((await client.get_counts())["archive_index"], 1)
+
+if __name__ == "__main__":
+    unittest.main() 
\ No newline at end of file
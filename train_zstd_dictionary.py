@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Train a zstd dictionary on sample billing records for compressing archived blobs
+"""
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+import zstandard as zstd
+
+from blob_client import BlobStorageClient
+from cosmos_client import ARCHIVAL_PROJECTION, CosmosDBClient
+
+async def fetch_samples(sample_count: int) -> list:
+    """Fetch sample records from Cosmos DB, serialized exactly as they are archived"""
+    cosmos_client = CosmosDBClient()
+    await cosmos_client.initialize()
+    try:
+        query = f"SELECT TOP @count {ARCHIVAL_PROJECTION} FROM c WHERE IS_DEFINED(c.created_at)"
+        parameters = [{"name": "@count", "value": sample_count}]
+        return [
+            BlobStorageClient._serialize_record(record) + b"\n"
+            async for record in cosmos_client.container.query_items(query=query, parameters=parameters)
+        ]
+    finally:
+        await cosmos_client.close()
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=10000, help="Number of records to train on")
+    parser.add_argument("--size", type=int, default=100_000, help="Dictionary size in bytes")
+    parser.add_argument("--output", default="billing_records.zdict", help="Where to write the dictionary")
+    args = parser.parse_args()
+    
+    print("🔧 zstd Dictionary Training")
+    print("=" * 50)
+    
+    samples = asyncio.run(fetch_samples(args.samples))
+    print(f"📦 Fetched {len(samples)} sample records")
+    
+    try:
+        dictionary = zstd.train_dictionary(args.size, samples)
+    except zstd.ZstdError as e:
+        print(f"❌ Failed to train dictionary (too few or too small samples?): {e}")
+        sys.exit(1)
+    
+    Path(args.output).write_bytes(dictionary.as_bytes())
+    print(f"✅ Wrote dictionary {dictionary.dict_id()} to {args.output}")
+    print(f"Set ZSTD_DICTIONARY_PATH={args.output} to compress new archives with it")
+    print("⚠️  Keep every dictionary that has been used: blobs compressed with it cannot be read without it")
+
+if __name__ == "__main__":
+    main()